@@ -1,51 +1,58 @@
-import alsaaudio
-import base64
 import collections
 import json
 from logzero import logger
 import os
+import subprocess
 import sys
 import time
 
 
-def open_capture_device(sample_rate, chunk_size):
-    return alsaaudio.PCM(
-        type=alsaaudio.PCM_CAPTURE,
-        mode=alsaaudio.PCM_ASYNC,
-        format=alsaaudio.PCM_FORMAT_S16_LE,
-        channels=1,
-        rate=sample_rate,
-        periodsize=chunk_size,
+def start_capture_process(sample_rate, chunk_size):
+    # arecord writes the raw samples to its stdout, so reading a chunk is a single
+    # blocking read instead of polling ALSA from Python. The period size determines
+    # how often arecord hands over new samples.
+    return subprocess.Popen(
+        [
+            "arecord",
+            "--quiet",
+            "--file-type=raw",
+            "--format=S16_LE",
+            "--channels=1",
+            f"--rate={sample_rate}",
+            f"--period-size={chunk_size}",
+        ],
+        stdout=subprocess.PIPE,
     )
 
 
-TimedData = collections.namedtuple("TimedData", ["data", "release_time"])
-
-
 def main():
     config = json.loads(os.environ["LIGHT_ORGAN_CONFIG"])
     logger.setLevel(config["log_level"])
 
-    capture_device = open_capture_device(
+    capture_process = start_capture_process(
         sample_rate=config["sample_rate"], chunk_size=config["chunk_size"]
     )
-    logger.info("PCM set up")
-
-    data_queue = []
-    while True:
-        try:
-            data_length, chunk = capture_device.read()
-            if data_length > 0:
-                data_queue.append(
-                    TimedData(
-                        data=base64.b64encode(chunk).decode("ascii"),
-                        release_time=time.monotonic() + config["delay"],
-                    )
-                )
-            if data_queue and data_queue[0].release_time <= time.monotonic():
-                print(data_queue.pop(0).data, file=sys.stdout)
-        except KeyboardInterrupt:
-            break
+    logger.info("Capture process started")
+
+    chunk_bytes = 2 * config["chunk_size"]  # 16 bit samples
+    delay_ns = round(config["delay"] * 1e9)
+
+    # FIFO of (release time in ns, chunk) tuples
+    data_queue = collections.deque()
+    try:
+        while True:
+            chunk = capture_process.stdout.read(chunk_bytes)
+            if not chunk:
+                break
+            data_queue.append((time.monotonic_ns() + delay_ns, chunk))
+            if data_queue and data_queue[0][0] <= time.monotonic_ns():
+                # Raw samples, visualize.py reads them in chunks of fixed size
+                sys.stdout.buffer.write(data_queue.popleft()[1])
+                sys.stdout.buffer.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture_process.terminate()
 
 
 if __name__ == "__main__":
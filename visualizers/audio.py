@@ -1,72 +1,183 @@
-import functools
+import collections
 import librosa
 from logzero import logger
 import math
-import multiprocessing
+import numba
 import numpy as np
-import scipy
+import scipy.fft
+import scipy.signal
 
 
 from .base import Visualizer
 
 
 # The classes StftVisualizer and IirtVisualizer provide process_audio_chunk
-# implementations that do audio analysis based on librosa.stft and librosa.iirt
-# respectively. Unfortunately, audio analysis based on IIRT is not fast enough even
-# though I tried heavily using custom implementations and multiprocessing. On my
-# Raspberry Pi 3B the best I could do is about 30 updates per second using 20 LEDs.
+# implementations that do audio analysis based on a windowed FFT (what librosa.stft
+# computes for a single frame) and librosa's IIRT filter bank respectively.
+# Unfortunately, audio analysis based on IIRT used to be not fast enough even though
+# I tried heavily using custom implementations and multiprocessing. On my Raspberry
+# Pi 3B the best I could do is about 30 updates per second using 20 LEDs.
 # Additionally, this was achieved using filter_layout='ba' which exhibits flickering
 # artifacts when tested using rising pure tones.
 #
-# Therefore, the use of IirtVisualizer is discouraged!
+# These numbers predate the current implementation, which applies all filters as
+# second-order sections in a numba kernel (sosfiltfilt_powers) and converts 'ba'
+# filters to that form as well. It has not been measured on the Pi yet, so the use
+# of IirtVisualizer is still discouraged!
+
+
+# Filters of the IIRT filter bank that operate at the same sample rate, together with
+# the polyphase resampling parameters needed to get the signal to that sample rate.
+# The filters are stacked as second-order sections, see sosfiltfilt_powers.
+FilterGroup = collections.namedtuple(
+    "FilterGroup",
+    ["leds", "sos", "zi", "padlens", "up", "down", "resampling_filter"],
+)
+
+
+@numba.njit(cache=True, fastmath=True)
+def _sosfilt_inplace(sos, zi, x):
+    # Direct form II transposed, the same recursion as scipy.signal.sosfilt
+    for n in range(x.shape[0]):
+        x_cur = x[n]
+        for s in range(sos.shape[0]):
+            x_new = sos[s, 0] * x_cur + zi[s, 0]
+            zi[s, 0] = sos[s, 1] * x_cur - sos[s, 4] * x_new + zi[s, 1]
+            zi[s, 1] = sos[s, 2] * x_cur - sos[s, 5] * x_new
+            x_cur = x_new
+        x[n] = x_cur
+
+
+@numba.njit(cache=True, fastmath=True, parallel=True)
+def sosfiltfilt_powers(signal, sos, zi, padlens, out):
+    # Computes np.mean(scipy.signal.sosfiltfilt(sos[i], signal) ** 2) for each filter
+    # i in parallel using numba threads. All filters need to have the same number of
+    # sections, shorter ones can be padded with the identity section [1, 0, 0, 1, 0, 0].
+    # zi and padlens are the results of scipy.signal.sosfilt_zi and the default
+    # padlen of scipy.signal.sosfiltfilt for each filter.
+    n = signal.shape[0]
+    for i in numba.prange(sos.shape[0]):
+        padlen = padlens[i]
+
+        # Odd extension of the signal at both ends, see scipy.signal._arraytools.odd_ext
+        extended = np.empty(n + 2 * padlen)
+        for j in range(padlen):
+            extended[j] = 2 * signal[0] - signal[padlen - j]
+            extended[n + padlen + j] = 2 * signal[n - 1] - signal[n - 2 - j]
+        extended[padlen : n + padlen] = signal
+
+        state = zi[i] * extended[0]
+        _sosfilt_inplace(sos[i], state, extended)
+        reversed_extended = extended[::-1]
+        state = zi[i] * reversed_extended[0]
+        _sosfilt_inplace(sos[i], state, reversed_extended)
+
+        power = 0.0
+        for j in range(padlen, n + padlen):
+            power += extended[j] ** 2
+        out[i] = power / n
 
 
 class BufferedAudioVisualizer(Visualizer):
-    def __init__(self, *, sample_rate, buffer_size, chunk_size, **kwargs):
+    def __init__(self, *, sample_rate, buffer_size, **kwargs):
         super().__init__(**kwargs)
         self.sample_rate = sample_rate
         self.buffer_size = buffer_size
-        self.chunk_size = chunk_size
 
         if self.chunk_size > self.buffer_size:
             raise RuntimeError(
                 "The chunk_size can be at most as large as the buffer_size"
             )
 
-        self.buffer = np.zeros(self.buffer_size, dtype=np.float64)
+        # The samples are kept in storage twice as large as the buffer. The buffer is
+        # a view of the most recent buffer_size samples, which are always contiguous.
+        # New chunks are appended behind the buffer and only when the storage is full,
+        # the buffer is moved back to the start of the storage.
+        self._storage = np.zeros(2 * self.buffer_size, dtype=np.float32)
+        self._buffer_end = self.buffer_size
 
         # Update REPORT_INTERVAL to print every 5 seconds
         self.REPORT_INTERVAL = math.ceil(5 / (self.chunk_size / self.sample_rate))
 
+    @property
+    def buffer(self):
+        return self._storage[self._buffer_end - self.buffer_size : self._buffer_end]
+
     def update_buffer(self, chunk):
-        if len(chunk) > self.buffer.shape[0]:
+        if len(chunk) > self.buffer_size:
             raise RuntimeError(
                 "The audio chunk is too large, please increase the buffer size"
             )
 
-        self.buffer = np.concatenate((self.buffer[len(chunk) :], chunk))
+        if self._buffer_end + len(chunk) > self._storage.shape[0]:
+            # Only the samples that stay in the buffer are moved
+            kept = self.buffer_size - len(chunk)
+            self._storage[:kept] = self._storage[
+                self._buffer_end - kept : self._buffer_end
+            ]
+            self._buffer_end = kept
+
+        # The int16 samples are converted to float32 while copied
+        self._storage[self._buffer_end : self._buffer_end + len(chunk)] = chunk
+        self._buffer_end += len(chunk)
 
 
 class StftVisualizer(BufferedAudioVisualizer):
     MAX_BRIGHTNESS_AMPLITUDE = 3_000_000
+    MAX_BRIGHTNESS_POWER = MAX_BRIGHTNESS_AMPLITUDE**2
+
+    def __init__(self, *, buffer_size, **kwargs):
+        # The FFT is a lot slower for lengths with large prime factors
+        fast_buffer_size = scipy.fft.next_fast_len(buffer_size, real=True)
+        if fast_buffer_size != buffer_size:
+            logger.warning(
+                f"buffer_size is not a fast FFT length, "
+                f"it was increased to {fast_buffer_size}"
+            )
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+        super().__init__(buffer_size=fast_buffer_size, **kwargs)
 
-        self.frequencies = librosa.fft_frequencies(
-            sr=self.sample_rate, n_fft=self.buffer_size
+        self.frequencies = scipy.fft.rfftfreq(self.buffer_size, 1 / self.sample_rate)
+        # Periodic Hann window, the default window of librosa.stft
+        self.window = scipy.signal.get_window("hann", self.buffer_size).astype(
+            np.float32
         )
-
-    def process_audio_chunk(self, chunk):
+        # Scratch space for the windowed signal, the FFT may overwrite it
+        self.windowed_buffer = np.zeros(self.buffer_size, dtype=np.float32)
+        # Plan the FFT for this length now instead of delaying the first frame.
+        # pocketfft caches the plan, and the cache is inherited by the forked
+        # audio processing process.
+        scipy.fft.rfft(self.windowed_buffer)
+
+        self.processed_audio_shape = self.frequencies.shape
+
+    def compute_spectrum(self, chunk):
+        """
+        Adds the chunk to the buffer and returns the spectrum of the windowed buffer
+        or None if there is no audio playing.
+        """
         if np.all(self.buffer == 0) and np.all(chunk == 0):
             # Reduce CPU load if there is no audio playing
             return None
 
         self.update_buffer(chunk)
-        amplitudes = np.abs(
-            librosa.stft(self.buffer, n_fft=self.buffer_size, center=False)
-        ).reshape(-1)
-        return amplitudes / self.MAX_BRIGHTNESS_AMPLITUDE
+
+        # The buffer is exactly one frame long, so this is what librosa.stft computes
+        # with center=False, but without its framing overhead. The signal is real, so
+        # rfft only computes the non-negative half of the spectrum.
+        np.multiply(self.buffer, self.window, out=self.windowed_buffer)
+        return scipy.fft.rfft(self.windowed_buffer, overwrite_x=True)
+
+    def process_audio_chunk(self, chunk):
+        spectrum = self.compute_spectrum(chunk)
+        if spectrum is None:
+            return None
+
+        # Return the power of each frequency instead of its amplitude. The subclasses
+        # average over many frequencies per LED anyway, so the square root is only
+        # taken once per LED and not once per frequency.
+        powers = spectrum.real**2 + spectrum.imag**2
+        return powers / self.MAX_BRIGHTNESS_POWER
 
 
 class IirtVisualizer(BufferedAudioVisualizer):
@@ -101,6 +212,19 @@ class IirtVisualizer(BufferedAudioVisualizer):
 
         return filterbank, sample_rates
 
+    @staticmethod
+    def design_resampling_filter(sample_rate, target_sample_rate):
+        # This is the filter scipy.signal.resample_poly designs on every call when
+        # used by librosa.resample with res_type="polyphase". Designing it once and
+        # passing it as the window gives the same result.
+        gcd = math.gcd(sample_rate, target_sample_rate)
+        up, down = target_sample_rate // gcd, sample_rate // gcd
+        max_rate = max(up, down)
+        resampling_filter = scipy.signal.firwin(
+            20 * max_rate + 1, 1 / max_rate, window=("kaiser", 5.0)
+        )
+        return up, down, resampling_filter
+
     def __init__(
         self,
         *,
@@ -126,59 +250,110 @@ class IirtVisualizer(BufferedAudioVisualizer):
         self.filterbank, self.sample_rates = self.generate_filter_bank(
             self.frequencies, self.filter_layout
         )
-        self.unique_sample_rates = np.unique(self.sample_rates)
-
-        self._compute_filter_power = {
-            "ba": self._compute_filter_power_ba,
-            "sos": self._compute_filter_power_sos,
-        }[self.filter_layout]
-
-        self.buffer = np.zeros(self.buffer_size, dtype=np.float64)
-
-    def _process_audio(self):
-        # A small hack to initialize the new pool inside the _process_audio process
-        with multiprocessing.Pool() as pool:
-            self.process_audio_chunk = functools.partial(
-                self.process_audio_chunk, pool=pool
+        self.processed_audio_shape = (self.led_count,)
+
+        # All filters that operate at the same sample rate are applied together, so
+        # that the signal is only resampled once per sample rate. The frequencies are
+        # sorted, so each group covers a contiguous range of LEDs and its powers are
+        # written directly into that slice of the amplitudes.
+        group_starts = np.flatnonzero(np.diff(self.sample_rates, prepend=-1) != 0)
+        group_stops = np.append(group_starts[1:], self.led_count)
+        self.filter_groups = []
+        for start, stop in zip(group_starts, group_stops):
+            up, down, resampling_filter = self.design_resampling_filter(
+                self.sample_rate, int(self.sample_rates[start])
+            )
+            sos, zi, padlens = self.stack_filters(
+                self.filterbank[start:stop], self.filter_layout
+            )
+            # Like scipy.signal.sosfiltfilt, the filters need a signal that is longer
+            # than their padding. sosfiltfilt_powers does not check this itself.
+            resampled_size = math.ceil(self.buffer_size * up / down)
+            if resampled_size <= padlens.max():
+                raise RuntimeError(
+                    f"The buffer_size is too small for the filters at "
+                    f"{int(self.sample_rates[start])} Hz, please increase it"
+                )
+            self.filter_groups.append(
+                FilterGroup(
+                    leds=slice(start, stop),
+                    sos=sos,
+                    zi=zi,
+                    padlens=padlens,
+                    up=up,
+                    down=down,
+                    resampling_filter=resampling_filter,
+                )
             )
-            super()._process_audio()
 
-    @staticmethod
-    def _compute_filter_power_ba(signal, cur_filter):
-        cur_filter_output = scipy.signal.filtfilt(cur_filter[0], cur_filter[1], signal)
-        return np.mean(cur_filter_output**2)
+        self.amplitudes = np.empty(self.led_count, dtype=np.float32)
+
+        # Compile sosfiltfilt_powers now, otherwise the audio process would stall on
+        # its first chunk. It is not called here, since that would start numba's
+        # thread pool, which not every threading layer survives across fork.
+        for filter_group in self.filter_groups:
+            resampled_signal = scipy.signal.resample_poly(
+                self.buffer,
+                filter_group.up,
+                filter_group.down,
+                window=filter_group.resampling_filter,
+            )
+            sosfiltfilt_powers.compile(
+                tuple(
+                    numba.typeof(argument)
+                    for argument in (
+                        resampled_signal,
+                        filter_group.sos,
+                        filter_group.zi,
+                        filter_group.padlens,
+                        self.amplitudes[filter_group.leds],
+                    )
+                )
+            )
 
     @staticmethod
-    def _compute_filter_power_sos(signal, cur_filter):
-        cur_filter_output = scipy.signal.sosfiltfilt(cur_filter, signal)
-        return np.mean(cur_filter_output**2)
+    def stack_filters(filters, filter_layout):
+        # Filters in the "ba" layout are converted to second-order sections as well,
+        # which is also numerically more stable
+        if filter_layout == "ba":
+            filters = [scipy.signal.tf2sos(b, a) for b, a in filters]
+
+        section_count = max(len(sos) for sos in filters)
+        stacked_sos = np.zeros((len(filters), section_count, 6))
+        stacked_sos[:, :, [0, 3]] = 1  # Identity sections
+        stacked_zi = np.zeros((len(filters), section_count, 2))
+        padlens = np.empty(len(filters), dtype=np.int64)
+        for i, sos in enumerate(filters):
+            stacked_sos[i, : len(sos)] = sos
+            stacked_zi[i, : len(sos)] = scipy.signal.sosfilt_zi(sos)
+            # The default padlen of scipy.signal.sosfiltfilt
+            ntaps = 2 * len(sos) + 1
+            ntaps -= min(np.sum(sos[:, 2] == 0), np.sum(sos[:, 5] == 0))
+            padlens[i] = 3 * ntaps
+
+        return stacked_sos, stacked_zi, padlens
 
-    def process_audio_chunk(self, chunk, pool):
+    def process_audio_chunk(self, chunk):
         if np.all(self.buffer == 0) and np.all(chunk == 0):
             # Reduce CPU load if there is no audio playing
             return None
 
         self.update_buffer(chunk)
 
-        resample_to_sr = functools.partial(
-            librosa.resample, self.buffer, self.sample_rate, res_type="polyphase"
-        )
-        resampled_signal = dict(
-            zip(
-                self.unique_sample_rates,
-                pool.map(resample_to_sr, self.unique_sample_rates),
+        for filter_group in self.filter_groups:
+            resampled_signal = scipy.signal.resample_poly(
+                self.buffer,
+                filter_group.up,
+                filter_group.down,
+                window=filter_group.resampling_filter,
             )
-        )
-
-        amplitudes = np.array(
-            pool.starmap(
-                self._compute_filter_power,
-                (
-                    (resampled_signal[cur_sr], cur_filter)
-                    for cur_sr, cur_filter in zip(self.sample_rates, self.filterbank)
-                ),
-                chunksize=math.ceil(len(self.sample_rates) / pool._processes),
+            sosfiltfilt_powers(
+                resampled_signal,
+                filter_group.sos,
+                filter_group.zi,
+                filter_group.padlens,
+                self.amplitudes[filter_group.leds],
             )
-        )
 
-        return amplitudes / self.MAX_BRIGHTNESS_AMPLITUDE
+        self.amplitudes /= self.MAX_BRIGHTNESS_AMPLITUDE
+        return self.amplitudes
@@ -1,5 +1,7 @@
 import abc
-import base64
+import contextlib
+import ctypes
+import functools
 import logging
 from logzero import logger
 import multiprocessing
@@ -10,8 +12,10 @@ import time
 
 
 class Timer:
+    # Each timer is only ever updated by a single process and only read for the
+    # debug report, so the shared value does not need a lock
     def __init__(self):
-        self.shared = multiprocessing.Value("d", 0)
+        self.shared = multiprocessing.RawValue("d", 0)
 
     @property
     def value(self):
@@ -21,17 +25,64 @@ class Timer:
         self.start_time = time.monotonic()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        with self.shared.get_lock():
-            self.shared.value += time.monotonic() - self.start_time
+        self.shared.value += time.monotonic() - self.start_time
+
+
+class SharedRingBuffer:
+    """
+    A queue of fixed-size arrays for exactly one producer and one consumer process.
+    The arrays are stored in shared memory, so unlike multiprocessing.Queue nothing is
+    pickled or sent through a pipe. The buffer has to be created before the processes
+    are forked.
+    """
+
+    def __init__(self, slot_count, shape, dtype):
+        self.slot_count = slot_count
+        dtype = np.dtype(dtype)
+        shared = multiprocessing.RawArray(
+            ctypes.c_byte, slot_count * int(np.prod(shape)) * dtype.itemsize
+        )
+        self.slots = np.frombuffer(shared, dtype=dtype).reshape(slot_count, *shape)
+
+        self.free_slots = multiprocessing.Semaphore(slot_count)
+        self.filled_slots = multiprocessing.Semaphore(0)
+        # Each index is only ever used by one process, so they need not be shared
+        self.write_index = 0
+        self.read_index = 0
+
+    def qsize(self):
+        return self.filled_slots.get_value()
+
+    def put(self, array):
+        self.free_slots.acquire()
+        self.slots[self.write_index] = array
+        self.write_index = (self.write_index + 1) % self.slot_count
+        self.filled_slots.release()
+
+    @contextlib.contextmanager
+    def get(self):
+        """
+        Yields the oldest array in the queue. The array is a view into shared memory
+        and its slot is only released after the with block, so the array must not be
+        used afterwards.
+        """
+        self.filled_slots.acquire()
+        try:
+            yield self.slots[self.read_index]
+        finally:
+            self.read_index = (self.read_index + 1) % self.slot_count
+            self.free_slots.release()
 
 
 class Visualizer(abc.ABC):
     LED_PIN = 21  # see README
     REPORT_INTERVAL = 50  # Print report every ... updates
+    RING_BUFFER_SLOTS = 8  # Number of chunks that can wait for processing
 
-    def __init__(self, *, led_count, led_offset=0):
+    def __init__(self, *, led_count, chunk_size, led_offset=0):
         super().__init__()
         self.led_count = led_count
+        self.chunk_size = chunk_size
         self.led_offset = led_offset
 
         # Create NeoPixel object with appropriate configuration.
@@ -41,23 +92,77 @@ class Visualizer(abc.ABC):
         self.strip.begin()
         logger.info("Strip intialized")
 
-        self.raw_audio_chunks = multiprocessing.Queue()
-        self.processed_audio = multiprocessing.Queue()
+        # The LED buffer of the C library is only allocated by begin(). Its address
+        # allows set_pixel_colors to write all LEDs at once.
+        try:
+            self.led_buffer_address = int(
+                rpi_ws281x.ws2811_channel_t_leds_get(self.strip._channel)
+            )
+        except (AttributeError, TypeError):
+            logger.warning("LED buffer not accessible, falling back to setPixelColor")
+            self.led_buffer_address = None
+            self.led_buffer = None
+        else:
+            # A numpy view of the LED buffer, which show_leds compares against the
+            # colors last sent to the strip
+            self.led_buffer = np.ctypeslib.as_array(
+                (ctypes.c_uint32 * self.strip.numPixels()).from_address(
+                    self.led_buffer_address
+                )
+            )
+
+        # The colors last sent to the strip, show_leds skips sending them again
+        self.shown_led_colors = None
 
         self.audio_processing_timer = Timer()
         self.led_timer = Timer()
 
     def turn_off_leds(self):
-        for i in range(self.strip.numPixels()):
-            self.strip.setPixelColor(i, rpi_ws281x.Color(0, 0, 0))
+        if self.led_buffer_address is None:
+            for i in range(self.strip.numPixels()):
+                self.strip.setPixelColor(i, rpi_ws281x.Color(0, 0, 0))
+        else:
+            ctypes.memset(self.led_buffer_address, 0, 4 * self.strip.numPixels())
+        self.strip.show()
+
+    def set_pixel_colors(self, colors):
+        """
+        Sets the colors of all LEDs starting at led_offset. The colors are given as an
+        array of led_count integers in the format returned by rpi_ws281x.Color.
+        """
+        colors = np.ascontiguousarray(colors, dtype=np.uint32)
+        if self.led_buffer_address is None:
+            for i, color in enumerate(colors.tolist(), start=self.led_offset):
+                self.strip.setPixelColor(i, color)
+        else:
+            # The C library stores each color as a uint32 (ws2811_led_t)
+            ctypes.memmove(
+                self.led_buffer_address + 4 * self.led_offset,
+                colors.ctypes.data,
+                colors.nbytes,
+            )
+
+    def show_leds(self):
+        """
+        Sends the LED colors to the strip, unless they are unchanged since the last
+        call. This can only be detected if the LED buffer is accessible.
+        """
+        if self.led_buffer is not None:
+            if np.array_equal(self.led_buffer, self.shown_led_colors):
+                return
+            self.shown_led_colors = self.led_buffer.copy()
+
         self.strip.show()
 
     @abc.abstractmethod
     def process_audio_chunk(self, chunk):
         # This function needs to be overwritten by the subclass to perform any audio
-        # processing needed. There are no restrictions on the type of data returned
-        # here. If it is not None, it is passed as is to set_led_colors. Otherwise, the
-        # data is ignored and set_led_colors is not called.
+        # processing needed. The chunk contains the raw 16 bit samples as int16 and is
+        # only valid during this call, any data needed later on has to be copied. The
+        # data returned here needs to be an array of shape self.processed_audio_shape,
+        # which has to be set by the subclass. If it is not None, it is passed to
+        # set_led_colors as float32. Otherwise, the data is ignored and
+        # set_led_colors is not called.
         return chunk
 
     @abc.abstractmethod
@@ -68,36 +173,42 @@ class Visualizer(abc.ABC):
 
     def _process_audio(self):
         while True:
-            chunk = self.raw_audio_chunks.get()
-
-            queue_size = self.raw_audio_chunks.qsize()
-            if queue_size > 3:
-                logger.warning(
-                    f"More audio chunks available than can be processed: {queue_size}"
-                )
+            with self.raw_audio_chunks.get() as chunk:
+                queue_size = self.raw_audio_chunks.qsize()
+                if queue_size > 3:
+                    logger.warning(
+                        f"More audio chunks available than can be processed: "
+                        f"{queue_size}"
+                    )
 
-            with self.audio_processing_timer:
-                processed = self.process_audio_chunk(chunk)
+                with self.audio_processing_timer:
+                    processed = self.process_audio_chunk(chunk)
 
             if processed is not None:
                 self.processed_audio.put(processed)
 
     def _update_leds(self):
         while True:
-            data = self.processed_audio.get()
-
-            queue_size = self.processed_audio.qsize()
-            if queue_size > 3:
-                logger.warning(
-                    f"More processed audio chunks available than can be processed: "
-                    f"{queue_size}"
-                )
+            with self.processed_audio.get() as data:
+                queue_size = self.processed_audio.qsize()
+                if queue_size > 3:
+                    logger.warning(
+                        f"More processed audio chunks available than can be "
+                        f"processed: {queue_size}"
+                    )
 
-            with self.led_timer:
-                self.set_led_colors(data)
-                self.strip.show()
+                with self.led_timer:
+                    self.set_led_colors(data)
+                    self.show_leds()
 
     def run(self):
+        self.raw_audio_chunks = SharedRingBuffer(
+            self.RING_BUFFER_SLOTS, (self.chunk_size,), np.int16
+        )
+        self.processed_audio = SharedRingBuffer(
+            self.RING_BUFFER_SLOTS, self.processed_audio_shape, np.float32
+        )
+
         try:
             processes = (
                 multiprocessing.Process(target=self._process_audio),
@@ -108,12 +219,15 @@ class Visualizer(abc.ABC):
 
             logger.info("Processes started")
 
-            sys.stdin.readline()  # Skip first line to get accurate timing results
+            # The audio arrives as raw 16 bit samples, chunk_size samples at a time.
+            # Every chunk is read into the same preallocated array.
+            samples = np.empty(self.chunk_size, dtype=np.int16)
+            read_chunk = functools.partial(sys.stdin.buffer.readinto, samples)
+
+            read_chunk()  # Skip first chunk to get accurate timing results
             start_time = time.monotonic()
-            for i, line in enumerate(sys.stdin, start=1):
-                binary_data = base64.b64decode(line)
-                chunk = np.frombuffer(binary_data, dtype=np.int16).astype(np.float64)
-                self.raw_audio_chunks.put(chunk)
+            for i, _ in enumerate(iter(read_chunk, 0), start=1):
+                self.raw_audio_chunks.put(samples)
 
                 if logger.isEnabledFor(logging.DEBUG) and i % self.REPORT_INTERVAL == 0:
                     total_time = time.monotonic() - start_time
@@ -1,6 +1,7 @@
 from logzero import logger
+import numba
 import numpy as np
-import scipy.integrate
+import scipy.sparse
 
 
 from .audio import StftVisualizer, IirtVisualizer
@@ -19,7 +20,28 @@ from .leds import BrightnessVisualizer
 # Brilliance      6000 - 20000   Sparkle
 
 
+@numba.njit(cache=True, fastmath=True)
+def band_rms(spectrum, starts, stops, scale, out):
+    """
+    Stores the square root of the mean power (times scale) of the complex spectrum
+    in spectrum[starts[i]:stops[i]] in out[i]. All bands are reduced in a single
+    compiled loop without computing the power of any other frequency.
+    """
+    for i in range(out.shape[0]):
+        total = 0.0
+        for j in range(starts[i], stops[i]):
+            total += spectrum[j].real ** 2 + spectrum[j].imag ** 2
+        out[i] = np.sqrt(scale * total / (stops[i] - starts[i]))
+
+
 class FrequencyVisualizer(StftVisualizer, BrightnessVisualizer):
+    # The brightness is the RMS amplitude of each LED's frequency range, which is a
+    # lot larger than the mean amplitude for tonal input. Calibrated on synthetic
+    # music, so that LEDs are about as bright as with the mean amplitude normalized
+    # by StftVisualizer.MAX_BRIGHTNESS_AMPLITUDE.
+    MAX_BRIGHTNESS_AMPLITUDE = 7_000_000
+    MAX_BRIGHTNESS_POWER = MAX_BRIGHTNESS_AMPLITUDE**2
+
     def __init__(
         self,
         *,
@@ -44,51 +66,74 @@ class FrequencyVisualizer(StftVisualizer, BrightnessVisualizer):
                 num=self.led_count + 1,
             )
 
+        self.averaging_matrix = self.interpolation_averaging_matrix(
+            x_new=self.boundaries, xs=self.frequencies
+        )
+
     @staticmethod
-    def interpolate_integral(x_new, xs, ys):
+    def interpolation_averaging_matrix(x_new, xs):
         """
-        Calculates the integral from xs[0] to t (for any t <= xs[-1]) of the
-        piecewise linear interpolant of (xs[0], ys[0]), ...
+        Returns a sparse matrix that maps ys to the averages of the piecewise linear
+        interpolant of (xs[0], ys[0]), ... between consecutive values of x_new.
         """
-        indices = np.searchsorted(xs, x_new, side="right") - 1
-        if (indices < 0).any():
+        if x_new[0] < xs[0]:
             raise ValueError("A value in x_new is below the interpolation range.")
-        if (x_new > np.max(xs)).any():
+        if x_new[-1] > xs[-1]:
             raise ValueError("A value in x_new is above the interpolation range.")
 
-        # Compute the desired values for all t in xs
-        cumulative = scipy.integrate.cumulative_trapezoid(y=ys, x=xs, initial=0)
-
-        # Compute the slope of each linear segment
-        # A zero is added at the end to avoid errors when np.max(xs) is in x_new
-        slopes = np.concatenate((np.diff(ys) / np.diff(xs), [0]))
-
-        # Look up the integral from 0 to the largest element of xs smaller than t and
-        # then add the remaining integral (which is a quadratic of the remainder)
-        x_remainder = x_new - xs[indices]
-        return (
-            cumulative[indices]
-            + (slopes[indices] / 2) * x_remainder**2
-            + ys[indices] * x_remainder
+        # Enumerate each pair of an interval [x_new[i], x_new[i + 1]] and a linear
+        # segment [xs[j], xs[j + 1]] that overlap
+        first_segments = np.searchsorted(xs, x_new[:-1], side="right") - 1
+        stop_segments = np.searchsorted(xs, x_new[1:], side="left")
+        counts = stop_segments - first_segments
+        rows = np.repeat(np.arange(len(x_new) - 1), counts)
+        segments = np.repeat(first_segments - np.cumsum(counts) + counts, counts)
+        segments += np.arange(len(segments))
+
+        # On the overlap [u, v] the interpolant is the weighted sum of ys[j] and
+        # ys[j + 1], whose integrals are quadratics in the distances to the ends
+        left, right = xs[segments], xs[segments + 1]
+        u = np.maximum(x_new[rows], left)
+        v = np.minimum(x_new[rows + 1], right)
+        scale = 2 * (right - left) * np.diff(x_new)[rows]
+        left_weights = ((right - u) ** 2 - (right - v) ** 2) / scale
+        right_weights = ((v - left) ** 2 - (u - left) ** 2) / scale
+
+        # Duplicate entries are summed up
+        return scipy.sparse.csr_matrix(
+            (
+                np.concatenate((left_weights, right_weights)),
+                (np.tile(rows, 2), np.concatenate((segments, segments + 1))),
+            ),
+            shape=(len(x_new) - 1, len(xs)),
+            dtype=np.float32,  # Same as the power spectrum
         )
 
-    def set_led_colors(self, normalized_amplitudes):
-        average_amplitudes = np.diff(
-            self.interpolate_integral(
-                x_new=self.boundaries,
-                xs=self.frequencies,
-                ys=normalized_amplitudes,
-            )
-        ) / np.diff(self.boundaries)
-        self.set_led_brightness_values(average_amplitudes)
+    def set_led_colors(self, normalized_powers):
+        # Average of the interpolated power spectrum between consecutive boundaries
+        average_powers = self.averaging_matrix @ normalized_powers
+        # Clip first to guard against tiny negative values from rounding errors. Both
+        # steps work in place on the freshly allocated average_powers.
+        np.clip(average_powers, 0, 1, out=average_powers)
+        self.set_led_brightness_values(np.sqrt(average_powers, out=average_powers))
 
 
 class FrequencyBandsVisualizer(StftVisualizer, BrightnessVisualizer):
+    # Calibrated like FrequencyVisualizer.MAX_BRIGHTNESS_AMPLITUDE, the bands are
+    # wider and hence their RMS amplitude exceeds their mean amplitude even more
+    MAX_BRIGHTNESS_AMPLITUDE = 8_000_000
+    MAX_BRIGHTNESS_POWER = MAX_BRIGHTNESS_AMPLITUDE**2
+
     COLORS = [
         (0, 0, 1),  # Pure blue
         (1, 0, 0),  # Pure red
         (0, 1, 0),  # Pure green
     ]
+    BANDS = [
+        (250, 500),  # Low midrange
+        (500, 2000),  # Midrange
+        (2000, 4000),  # Upper midrange
+    ]
 
     def __init__(self, *, led_count, rgb_color_factory=None, **kwargs):
         self.leds_per_band = led_count // len(self.COLORS)
@@ -112,20 +157,54 @@ class FrequencyBandsVisualizer(StftVisualizer, BrightnessVisualizer):
             **kwargs,
         )
 
-        self.band_masks = [
-            (250 < self.frequencies) & (self.frequencies <= 500),  # Low midrange
-            (500 < self.frequencies) & (self.frequencies <= 2000),  # Midrange
-            (2000 < self.frequencies) & (self.frequencies <= 4000),  # Upper midrange
-        ]
-        self.band_sizes = [np.sum(mask) for mask in self.band_masks]
+        # Each band contains the frequencies in (low, high]. The frequencies are
+        # sorted, so this is always a contiguous range of bins.
+        low, high = np.transpose(self.BANDS)
+        self.band_starts = np.searchsorted(self.frequencies, low, side="right")
+        self.band_stops = np.searchsorted(self.frequencies, high, side="right")
+        if np.any(self.band_starts == self.band_stops):
+            raise RuntimeError(
+                "The buffer_size is too small to resolve all frequency bands"
+            )
 
-    def set_led_colors(self, normalized_amplitudes):
-        brightness_values = [
-            np.sum(normalized_amplitudes[mask]) / size
-            for mask, size in zip(self.band_masks, self.band_sizes)
-        ]
-        brightness_values = np.repeat(brightness_values, self.leds_per_band)
-        self.set_led_brightness_values(brightness_values)
+        # Only the band brightness values are passed on to set_led_colors
+        self.band_brightness_values = np.empty(len(self.BANDS), dtype=np.float32)
+        self.processed_audio_shape = self.band_brightness_values.shape
+        # Index of the band of each LED, used to expand the band brightness values
+        self.led_bands = np.repeat(np.arange(len(self.BANDS)), self.leds_per_band)
+        self.led_brightness_values = np.empty(self.led_count, dtype=np.float32)
+
+        # Compile band_rms now instead of on the first chunk of the forked audio
+        # process
+        band_rms(
+            np.zeros(len(self.frequencies), dtype=np.complex64),
+            self.band_starts,
+            self.band_stops,
+            1 / self.MAX_BRIGHTNESS_POWER,
+            self.band_brightness_values,
+        )
+
+    def process_audio_chunk(self, chunk):
+        spectrum = self.compute_spectrum(chunk)
+        if spectrum is None:
+            return None
+
+        band_rms(
+            spectrum,
+            self.band_starts,
+            self.band_stops,
+            1 / self.MAX_BRIGHTNESS_POWER,
+            self.band_brightness_values,
+        )
+        return self.band_brightness_values
+
+    def set_led_colors(self, band_brightness_values):
+        np.take(
+            band_brightness_values,
+            self.led_bands,
+            out=self.led_brightness_values,
+        )
+        self.set_led_brightness_values(self.led_brightness_values)
 
 
 class IirtBrightnessVisualizer(IirtVisualizer, BrightnessVisualizer):
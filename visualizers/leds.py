@@ -1,37 +1,76 @@
-import colorsys
 from logzero import logger
+import numba
 import numpy as np
-import rpi_ws281x
 
 
 from .base import Visualizer
 
 
+# Offsets of the red, green and blue channels on the hue circle (in sixths)
+HSV_CHANNEL_OFFSETS = np.array([5, 3, 1], dtype=np.float64)
+
+
+def hsv_to_rgb(hue, saturation, value):
+    """
+    Vectorized version of colorsys.hsv_to_rgb. The arguments are broadcast against
+    each other and the red, green and blue values are stacked along a new last axis.
+    """
+    hue, saturation, value = (
+        np.asarray(x, dtype=np.float64)[..., np.newaxis]
+        for x in np.broadcast_arrays(hue, saturation, value)
+    )
+
+    # Branchless formulation: Each channel is value * (1 - saturation * weight)
+    # where the weight is a trapezoid of the hue, shifted differently per channel
+    k = (hue * 6 + HSV_CHANNEL_OFFSETS) % 6
+    weight = np.clip(np.minimum(k, 4 - k), 0, 1)
+    return value * (1 - saturation * weight)
+
+
+@numba.njit(cache=True)
+def pack_led_colors(brightness_values, base_colors, out):
+    # Scales each base color (8 bit channels) by its brightness value (clipped to
+    # [0, 1]) and packs the channels like rpi_ws281x.Color, in a single pass
+    for i in range(out.shape[0]):
+        level = np.uint32(np.rint(255 * min(max(brightness_values[i], 0.0), 1.0)))
+        color = np.uint32(0)
+        for channel in range(3):
+            value = (level * base_colors[i, channel] + 127) // 255
+            color |= np.uint32(value) << np.uint32(16 - 8 * channel)
+        out[i] = color
+
+
 class ColorFactory:
     @staticmethod
     def WHITE(led_count):
-        return [(1, 1, 1) for _ in range(led_count)]
+        return np.ones((led_count, 3))
 
     @staticmethod
     def RAINBOW(led_count):
-        return [
-            colorsys.hsv_to_rgb(hue, 1, 1)
-            for hue in np.linspace(0, 1, led_count, endpoint=False)
-        ]
+        return hsv_to_rgb(np.linspace(0, 1, led_count, endpoint=False), 1, 1)
 
 
 class BrightnessVisualizer(Visualizer):
     def __init__(self, *, rgb_color_factory=ColorFactory.WHITE, **kwargs):
         super().__init__(**kwargs)
-        self.led_base_colors = np.array(
-            rgb_color_factory(self.led_count), dtype=np.float64
+        # The LED colors are computed in 8 bit fixed point arithmetic, i.e. each
+        # channel and each brightness value is an integer between 0 and 255
+        self.led_base_colors = np.rint(
+            255 * np.asarray(rgb_color_factory(self.led_count), dtype=np.float64)
+        ).astype(np.uint32)
+        self.led_colors = np.empty(self.led_count, dtype=np.uint32)
+        # Compile pack_led_colors now instead of on the first frame of the forked
+        # LED process
+        pack_led_colors(
+            np.zeros(self.led_count, dtype=np.float32),
+            self.led_base_colors,
+            self.led_colors,
         )
 
     def set_led_brightness_values(self, brightness_values):
-        colors = np.clip(brightness_values, 0, 1).reshape(-1, 1) * self.led_base_colors
-        bit_colors = [
-            rpi_ws281x.Color(round(red * 255), round(green * 255), round(blue * 255))
-            for (red, green, blue) in colors
-        ]
-        for i, bit_color in enumerate(bit_colors, start=self.led_offset):
-            self.strip.setPixelColor(i, bit_color)
+        pack_led_colors(
+            np.asarray(brightness_values, dtype=np.float32),
+            self.led_base_colors,
+            self.led_colors,
+        )
+        self.set_pixel_colors(self.led_colors)